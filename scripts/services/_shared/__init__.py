@@ -0,0 +1,2 @@
+# Helpers shared by the service servers. Each server.py runs as a plain script, so it puts
+# scripts/services on sys.path before importing from here.
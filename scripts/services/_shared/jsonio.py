@@ -0,0 +1,16 @@
+from __future__ import annotations
+
+import json
+
+try:
+    import orjson  # type: ignore
+
+    loads = orjson.loads
+    dumps = orjson.dumps
+except ImportError:
+    # orjson is optional; stdlib json produces the same documents, just slower.
+    def loads(raw: bytes):
+        return json.loads(raw.decode("utf-8"))
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
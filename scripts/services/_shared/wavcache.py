@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import atexit
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class WavCache:
+    # Process-wide LRU of synthesized WAVs, bounded by entry count and total bytes.
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._items: OrderedDict[bytes, bytes] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: bytes) -> bytes | None:
+        with self._lock:
+            wav = self._items.get(key)
+            if wav is not None:
+                self._items.move_to_end(key)
+            return wav
+
+    def put(self, key: bytes, wav: bytes) -> None:
+        if len(wav) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._items[key] = wav
+            self._bytes += len(wav)
+            while len(self._items) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+
+
+class DiskWavCache:
+    # Persistent WAV cache with content-hash filenames, so restarts don't re-synthesize.
+    def __init__(self, root: str, max_bytes: int, evict_every: int = 32):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        self.scratch = ""
+        if not self.enabled:
+            return
+        try:
+            os.makedirs(root, exist_ok=True)
+            # Partial writes go to a per-process scratch dir inside the cache (same filesystem,
+            # so os.replace stays atomic), and anything left there is removed at exit.
+            self._sweep_scratch()
+            self.scratch = tempfile.mkdtemp(prefix=f".scratch-{os.getpid()}-", dir=root)
+        except OSError as e:
+            # e.g. another user already owns the directory under a shared /tmp. Serve without
+            # the disk cache rather than refuse to start.
+            print(f"[{os.path.basename(root)}] disk WAV cache disabled: {e}")
+            self.max_bytes = 0
+            return
+        atexit.register(shutil.rmtree, self.scratch, ignore_errors=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _sweep_scratch(self) -> None:
+        # atexit doesn't run on SIGTERM; clear scratch dirs whose owning process is gone.
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if not entry.name.startswith(".scratch-"):
+                    continue
+                try:
+                    os.kill(int(entry.name.split("-")[1]), 0)
+                    continue
+                except (ValueError, IndexError, ProcessLookupError):
+                    pass
+                except OSError:
+                    # Alive but owned by someone else.
+                    continue
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def path_for(self, key: bytes) -> str:
+        return os.path.join(self.root, key.hex() + ".wav")
+
+    def put(self, key: bytes, wav: bytes) -> None:
+        if not self.enabled:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.scratch, suffix=".part")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(wav)
+            os.replace(tmp, self.path_for(key))
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            self._writes += 1
+            due = self._writes % self.evict_every == 0
+        if due:
+            self._evict()
+
+    def _evict(self) -> None:
+        # Drop least-recently-read files (by atime) until the directory fits the budget.
+        entries: list[tuple[float, int, str]] = []
+        total = 0
+        try:
+            it = os.scandir(self.root)
+        except OSError:
+            return
+        with it:
+            for entry in it:
+                if not entry.name.endswith(".wav"):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_atime, st.st_size, entry.path))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+
+
+def cache_key(*parts: object) -> bytes:
+    return hashlib.blake2b("\x00".join(str(p) for p in parts).encode("utf-8"), digest_size=20).digest()
+
+
+def send_file(handler, path: str, content_type: str) -> bool:
+    # Stream a cached file with sendfile(2); returns False if it isn't there (or was evicted).
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return False
+    with f:
+        st = os.fstat(f.fileno())
+        # Bump atime explicitly; relatime/noatime mounts won't do it for us. Best effort: a file
+        # we can read but not touch just ages out of the LRU sooner.
+        try:
+            os.utime(f.fileno(), ns=(time.time_ns(), st.st_mtime_ns))
+        except OSError:
+            pass
+        handler.send_response(200)
+        handler.send_header("content-type", content_type)
+        handler.send_header("content-length", str(st.st_size))
+        handler.end_headers()
+        handler.wfile.flush()
+        offset = 0
+        try:
+            while offset < st.st_size:
+                sent = os.sendfile(handler.connection.fileno(), f.fileno(), offset, st.st_size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except (AttributeError, OSError):
+            # No sendfile for this platform/socket: finish with a plain userspace copy.
+            f.seek(offset)
+            shutil.copyfileobj(f, handler.wfile)
+    return True
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import os
+import signal
+import socket
+import sys
+import traceback
+from typing import Callable
+
+
+def run(args, serve: Callable[..., int], tag: str) -> int:
+    # serve(args, reuse_port=...) runs one server process; --workers N forks N of them.
+    if args.workers > 1:
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+            print(f"[{tag}] --workers needs fork() and SO_REUSEPORT; running a single process")
+        else:
+            return _serve_workers(args, serve, tag)
+    return serve(args)
+
+
+def _serve_workers(args, serve: Callable[..., int], tag: str) -> int:
+    # Fork before anything touches MLX: each worker loads its own model copy and batch thread.
+    devices = [d for d in os.environ.get("CUDA_VISIBLE_DEVICES", "").split(",") if d.strip()]
+    children: list[int] = []
+    for i in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            if devices:
+                # Spread workers across the GPUs we were given, one device each.
+                os.environ["CUDA_VISIBLE_DEVICES"] = devices[i % len(devices)]
+            code = 1
+            try:
+                code = serve(args, reuse_port=True)
+            except KeyboardInterrupt:
+                code = 0
+            except Exception:
+                # os._exit skips the interpreter's own traceback printing; without this a
+                # failed model load would leave only the exit status.
+                traceback.print_exc()
+                sys.stderr.flush()
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+        children.append(pid)
+
+    def forward(signum, _frame) -> None:
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    print(f"[{tag}] started {len(children)} workers on port {args.port}")
+
+    status = 0
+    for pid in children:
+        _, code = os.waitpid(pid, 0)
+        status = status or os.waitstatus_to_exitcode(code)
+    return status
@@ -88,6 +88,7 @@ uv pip install --python "$PY" \
   torchaudio \
   numpy \
   soundfile \
+  orjson \
   librosa \
   scipy \
   tqdm \
@@ -68,5 +68,8 @@ export CHATTERBOX_EXAGGERATION="${CHATTERBOX_EXAGGERATION:-1.0}"
 export CHATTERBOX_TEMPERATURE="${CHATTERBOX_TEMPERATURE:-0.7}"
 export CHATTERBOX_CFG_WEIGHT="${CHATTERBOX_CFG_WEIGHT:-0.5}"
 export CHATTERBOX_CHUNK_SIZE="${CHATTERBOX_CHUNK_SIZE:-250}"
+export CHATTERBOX_CACHE_MB="${CHATTERBOX_CACHE_MB:-256}"
+export CHATTERBOX_DISK_CACHE_MB="${CHATTERBOX_DISK_CACHE_MB:-1024}"
+# Set CHATTERBOX_QUANTIZE=int8 to run the T3 model with dynamic int8 Linear layers (CPU only).
 
 exec "$PY" "$ROOT_DIR/scripts/services/chatterbox/server.py" --host "$CHATTERBOX_HOST" --port "$CHATTERBOX_PORT"
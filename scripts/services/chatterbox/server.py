@@ -2,21 +2,81 @@
 from __future__ import annotations
 
 import argparse
-import json
+import hashlib
 import os
+import queue
+import re
+import struct
 import sys
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import List
 
 import numpy as np
 import torch
 
+# Run as a script: put scripts/services on the path for the helpers in _shared/.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from _shared.jsonio import loads as _loads  # noqa: E402
+from _shared.wavcache import DiskWavCache, WavCache, cache_key as _cache_key, send_file as _send_file  # noqa: E402
+
 
 MODEL = None
 MODEL_SR = None
+DEFAULT_CONDS = None
 DEVICE = "cpu"
 
+_SENT_RE = re.compile(r"(?<=[.!?])\s+")
+_COMMA_RE = re.compile(r"(?<=,)\s+")
+
+# Number of text chunks synthesized concurrently. Defaults to 1: every chunk runs on the one
+# shared ChatterboxTTS, whose generate() rebuilds per-call state on the model (T3's patched
+# model and alignment hooks, conds.t3), so concurrent chunks can clobber each other. Raise
+# CHATTERBOX_PARALLEL only with a chatterbox build known to be reentrant.
+PARALLEL = 1
+_POOL: ThreadPoolExecutor | None = None
+_STREAMS = threading.local()
+_MODEL_LOCK = threading.Lock()
+
+
+_CACHE_MB = int(os.environ.get("CHATTERBOX_CACHE_MB", "256"))
+CACHE = WavCache(512, _CACHE_MB * 1024 * 1024)
+DISK_CACHE = DiskWavCache(
+    os.path.join(tempfile.gettempdir(), "agentloop-tts-cache", "chatterbox"),
+    int(os.environ.get("CHATTERBOX_DISK_CACHE_MB", "1024")) * 1024 * 1024,
+)
+
+# Part of every cache key: int8 weights change the audio, so it must not be served from a
+# full-precision run's cache (or vice versa).
+_QUANTIZE = os.environ.get("CHATTERBOX_QUANTIZE", "").lower()
+
+_VOICE_DIGESTS: dict[tuple[str, int, int], str] = {}
+
+
+def _voice_digest(path: str | None) -> str | None:
+    # Key on the prompt audio's contents so replacing a voice file invalidates cached audio.
+    # None when the file can't be read: the request then skips the cache, and synthesis
+    # reports the error.
+    if not path:
+        return ""
+    try:
+        st = os.stat(path)
+        stamp = (path, st.st_mtime_ns, st.st_size)
+        digest = _VOICE_DIGESTS.get(stamp)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+            digest = h.hexdigest()
+            _VOICE_DIGESTS[stamp] = digest
+    except OSError:
+        return None
+    return digest
+
 
 def _pick_device() -> str:
     device = os.environ.get("CHATTERBOX_DEVICE", "cpu").lower()
@@ -35,7 +95,7 @@ def _pick_device() -> str:
 
 
 def _load_model() -> None:
-    global MODEL, MODEL_SR, DEVICE
+    global MODEL, MODEL_SR, DEVICE, PARALLEL, DEFAULT_CONDS
     if MODEL is not None:
         return
 
@@ -66,117 +126,307 @@ def _load_model() -> None:
             if hasattr(model, "device"):
                 model.device = DEVICE
 
+    if _QUANTIZE == "int8" and DEVICE == "cpu" and getattr(model, "t3", None) is not None:
+        # Dynamic int8 Linear layers: ~4x smaller T3 weights and faster CPU matmuls.
+        try:
+            model.t3 = torch.ao.quantization.quantize_dynamic(model.t3, {torch.nn.Linear}, dtype=torch.qint8)
+        except Exception as e:
+            print(f"[chatterbox] int8 quantization failed; using full precision: {e}")
+
     MODEL = model
     MODEL_SR = getattr(model, "sr", None)
+    # prepare_conditionals() replaces model.conds for good; requests without a voice put the
+    # built-in ones back, or they'd speak (and be cached) in the last custom voice.
+    DEFAULT_CONDS = getattr(model, "conds", None)
+    PARALLEL = max(1, int(os.environ.get("CHATTERBOX_PARALLEL", "1")))
 
 
 def _split_text(text: str, max_chars: int) -> List[str]:
     if len(text) <= max_chars:
         return [text]
 
-    import re
-
-    sentences = re.split(r"(?<=[.!?])\s+", text)
     chunks: List[str] = []
-    current = ""
-
-    for sentence in sentences:
-        if len(sentence) > max_chars:
-            if current:
-                chunks.append(current.strip())
-                current = ""
-
-            parts = re.split(r"(?<=,)\s+", sentence)
-            for part in parts:
-                if len(part) > max_chars:
-                    words = part.split()
-                    word_chunk = ""
-                    for word in words:
-                        if len(word_chunk + " " + word) <= max_chars:
-                            word_chunk = (word_chunk + " " + word).strip()
-                        else:
-                            if word_chunk:
-                                chunks.append(word_chunk.strip())
-                            word_chunk = word
-                    if word_chunk:
-                        chunks.append(word_chunk.strip())
+    # Pending chunk as a list of pieces plus the length of their " "-joined form.
+    cur_parts: List[str] = []
+    cur_len = 0
+
+    def flush() -> None:
+        nonlocal cur_len
+        if cur_parts:
+            chunks.append(" ".join(cur_parts))
+            cur_parts.clear()
+            cur_len = 0
+
+    def push(piece: str) -> None:
+        nonlocal cur_len
+        if cur_len + 1 + len(piece) > max_chars:
+            flush()
+        cur_len = cur_len + 1 + len(piece) if cur_parts else len(piece)
+        cur_parts.append(piece)
+
+    for sentence in _SENT_RE.split(text):
+        if len(sentence) <= max_chars:
+            push(sentence)
+            continue
+
+        flush()
+        for part in _COMMA_RE.split(sentence):
+            if len(part) <= max_chars:
+                push(part)
+                continue
+
+            # Words of an over-long clause go straight to their own chunks.
+            words: List[str] = []
+            words_len = 0
+            for word in part.split():
+                if words_len + 1 + len(word) <= max_chars:
+                    words_len = words_len + 1 + len(word) if words else len(word)
+                    words.append(word)
                 else:
-                    if len(current + " " + part) <= max_chars:
-                        current = (current + " " + part).strip()
-                    else:
-                        if current:
-                            chunks.append(current.strip())
-                        current = part
-        else:
-            if len(current + " " + sentence) <= max_chars:
-                current = (current + " " + sentence).strip()
+                    if words:
+                        chunks.append(" ".join(words))
+                    words = [word]
+                    words_len = len(word)
+            if words:
+                chunks.append(" ".join(words))
+
+    flush()
+    return [c for c in chunks if c.strip()]
+
+
+def _chunk_pool() -> ThreadPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        _POOL = ThreadPoolExecutor(max_workers=PARALLEL, thread_name_prefix="chatterbox-chunk")
+    return _POOL
+
+
+def _synthesize_chunk(chunk: str, kwargs: dict):
+    # Runs on a pool thread. torch releases the GIL inside forward passes, so plain threads
+    # already overlap on CPU; on CUDA each thread also gets its own stream.
+    if DEVICE != "cuda":
+        return MODEL.generate(chunk, **kwargs)
+
+    stream = getattr(_STREAMS, "stream", None)
+    if stream is None:
+        stream = _STREAMS.stream = torch.cuda.Stream()
+    with torch.cuda.stream(stream):
+        wav = MODEL.generate(chunk, **kwargs)
+    stream.synchronize()
+    return wav
+
+
+def _synthesize(
+    text: str,
+    audio_prompt_path: str | None,
+    exaggeration: float,
+    temperature: float,
+    cfg_weight: float,
+    chunk_size: int,
+    out: queue.Queue,
+    cancel: threading.Event,
+) -> None:
+    # Runs on its own thread and pushes ("wav", tensor) per chunk, then ("done", None)
+    # or ("error", exc). Only this thread holds _MODEL_LOCK, and it never touches a socket.
+    try:
+        with _MODEL_LOCK:
+            _load_model()
+        if MODEL is None:
+            raise RuntimeError("Model failed to load")
+
+        chunks = _split_text(text, chunk_size)
+
+        with _MODEL_LOCK:
+            # Conditionals live on the model, so prepare them once per request and let the
+            # chunk workers share them read-only.
+            if audio_prompt_path:
+                MODEL.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
+            elif DEFAULT_CONDS is not None:
+                MODEL.conds = DEFAULT_CONDS
+
+            kwargs = {"exaggeration": exaggeration, "temperature": temperature, "cfg_weight": cfg_weight}
+            if len(chunks) == 1 or PARALLEL <= 1:
+                for chunk in chunks:
+                    if cancel.is_set():
+                        break
+                    out.put(("wav", MODEL.generate(chunk, **kwargs)))
             else:
-                if current:
-                    chunks.append(current.strip())
-                current = sentence
+                futures = [_chunk_pool().submit(_synthesize_chunk, chunk, kwargs) for chunk in chunks]
+                try:
+                    for f in futures:
+                        if cancel.is_set():
+                            break
+                        out.put(("wav", f.result()))
+                finally:
+                    for f in futures:
+                        f.cancel()
+                    # cancel() only drops chunks that haven't started; the running ones must
+                    # finish before the next request may swap MODEL.conds.
+                    wait(futures)
+        out.put(("done", None))
+    except Exception as e:
+        out.put(("error", e))
+
+
+def _generate_chunks(text: str, audio_prompt_path: str | None, exaggeration: float, temperature: float, cfg_weight: float, chunk_size: int):
+    # Yields one wav per text chunk, in order, as soon as each one is ready. A slow consumer
+    # only delays itself: synthesis finishes into the queue and releases the model, and
+    # closing the generator early stops it after the chunks already running.
+    out: queue.Queue = queue.Queue()
+    cancel = threading.Event()
+    threading.Thread(
+        target=_synthesize,
+        args=(text, audio_prompt_path, exaggeration, temperature, cfg_weight, chunk_size, out, cancel),
+        name="chatterbox-synth",
+        daemon=True,
+    ).start()
+    try:
+        while True:
+            kind, value = out.get()
+            if kind == "done":
+                return
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        cancel.set()
 
-    if current:
-        chunks.append(current.strip())
 
-    return [c for c in chunks if c.strip()]
+def _silence_samples() -> int:
+    return int(0.3 * (MODEL_SR or 24000))
 
 
 def _generate_wav(text: str, audio_prompt_path: str | None, exaggeration: float, temperature: float, cfg_weight: float, chunk_size: int):
-    _load_model()
-    if MODEL is None:
-        raise RuntimeError("Model failed to load")
-
-    chunks = _split_text(text, chunk_size)
-    wavs = []
-
-    for chunk in chunks:
-        wav = MODEL.generate(
-            chunk,
-            audio_prompt_path=audio_prompt_path,
-            exaggeration=exaggeration,
-            temperature=temperature,
-            cfg_weight=cfg_weight,
-        )
-        wavs.append(wav)
+    wavs = list(_generate_chunks(text, audio_prompt_path, exaggeration, temperature, cfg_weight, chunk_size))
 
     if len(wavs) == 1:
         return wavs[0]
 
-    silence_samples = int(0.3 * (MODEL_SR or 24000))
-    silence = torch.zeros(1, silence_samples, dtype=wavs[0].dtype)
-    if wavs[0].device.type != "cpu":
-        silence = silence.to(wavs[0].device)
-
-    combined = wavs[0]
-    for wav in wavs[1:]:
-        combined = torch.cat([combined, silence, wav], dim=1)
-    return combined
+    # Fill one preallocated tensor instead of re-concatenating the growing prefix.
+    silence_samples = _silence_samples()
+    first = wavs[0]
+    total = sum(w.size(-1) for w in wavs) + silence_samples * (len(wavs) - 1)
+    out = torch.empty((first.size(0), total), dtype=first.dtype, device=first.device)
+    off = 0
+    for i, wav in enumerate(wavs):
+        if i:
+            out[:, off : off + silence_samples] = 0
+            off += silence_samples
+        n = wav.size(-1)
+        out[:, off : off + n] = wav
+        off += n
+    return out
+
+
+def _pcm16(wav) -> bytes:
+    return (wav.detach().reshape(-1).clamp(-1.0, 1.0) * 32767).to(torch.int16).cpu().numpy().tobytes()
+
+
+def _wav_header(n_samples: int | None, sr: int, channels: int = 1) -> bytes:
+    # 44-byte PCM16 RIFF header. n_samples=None writes 0xFFFFFFFF sizes for streamed output.
+    block_align = channels * 2
+    if n_samples is None:
+        data_size = riff_size = 0xFFFFFFFF
+    else:
+        data_size = n_samples * block_align
+        riff_size = 36 + data_size
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        riff_size,
+        b"WAVE",
+        b"fmt ",
+        16,
+        1,
+        channels,
+        sr,
+        sr * block_align,
+        block_align,
+        16,
+        b"data",
+        data_size,
+    )
 
 
 class Handler(BaseHTTPRequestHandler):
     server_version = "agentloop-chatterbox-tts/0.1"
+    # HTTP/1.1 so streamed responses can use chunked transfer encoding.
+    protocol_version = "HTTP/1.1"
 
     def _send(self, status: int, body: bytes, content_type: str = "text/plain; charset=utf-8") -> None:
         self.send_response(status)
+        if self.close_connection:
+            self.send_header("connection", "close")
         self.send_header("content-type", content_type)
         self.send_header("content-length", str(len(body)))
         self.end_headers()
         self.wfile.write(body)
 
-    def do_GET(self) -> None:  # noqa: N802
-        if self.path == "/health":
-            self._send(200, b"ok\n")
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def _stream_wav(self, key: bytes | None, chunks) -> None:
+        # Send each chunk's PCM as soon as it is synthesized; the WAV header carries
+        # "unknown length" sizes, which streaming players accept.
+        try:
+            first = next(chunks)
+        except Exception as e:
+            self._send(500, f"tts failed: {e}\n".encode("utf-8"))
             return
-        if self.path == "/":
-            self._send(200, b"agentloop chatterbox tts server\n")
+
+        sr = int(MODEL_SR or 24000)
+        keep = key is not None and (CACHE.max_bytes > 0 or DISK_CACHE.enabled)
+        parts: list[bytes] = []
+        silence = b"\x00\x00" * _silence_samples()
+
+        self.send_response(200)
+        self.send_header("content-type", "audio/wav")
+        self.send_header("transfer-encoding", "chunked")
+        self.end_headers()
+        try:
+            self._write_chunk(_wav_header(None, sr))
+            pcm = _pcm16(first)
+            self._write_chunk(pcm)
+            if keep:
+                parts.append(pcm)
+            for wav in chunks:
+                pcm = _pcm16(wav)
+                self._write_chunk(silence + pcm)
+                if keep:
+                    parts.extend((silence, pcm))
+            self.wfile.write(b"0\r\n\r\n")
+        except Exception as e:
+            # Headers are gone already; all we can do is drop the connection mid-body.
+            print(f"[chatterbox] stream aborted: {e}")
+            self.close_connection = True
             return
+        finally:
+            chunks.close()
+
+        if keep:
+            data = b"".join(parts)
+            audio = _wav_header(len(data) // 2, sr) + data
+            CACHE.put(key, audio)
+            DISK_CACHE.put(key, audio)
+
+    def _h_health(self) -> None:
+        self._send(200, b"ok\n")
+
+    def _h_root(self) -> None:
+        self._send(200, b"agentloop chatterbox tts server\n")
+
+    def _h_not_found(self) -> None:
+        # Under HTTP/1.1 an unread request body would be parsed as the next request line.
+        self.close_connection = True
         self._send(404, b"not found\n")
 
+    def do_GET(self) -> None:  # noqa: N802
+        self._GET_ROUTES.get(self.path, Handler._h_not_found)(self)
+
     def do_POST(self) -> None:  # noqa: N802
-        if self.path != "/tts":
-            self._send(404, b"not found\n")
-            return
+        self._POST_ROUTES.get(self.path, Handler._h_not_found)(self)
 
+    def _h_tts(self) -> None:
         length = int(self.headers.get("content-length") or "0")
         raw = self.rfile.read(length) if length > 0 else b""
         content_type = (self.headers.get("content-type") or "").lower()
@@ -187,10 +437,11 @@ class Handler(BaseHTTPRequestHandler):
         temperature = float(os.environ.get("CHATTERBOX_TEMPERATURE", "0.7"))
         cfg_weight = float(os.environ.get("CHATTERBOX_CFG_WEIGHT", "0.5"))
         chunk_size = int(os.environ.get("CHATTERBOX_CHUNK_SIZE", "250"))
+        stream = False
 
         if "application/json" in content_type:
             try:
-                payload = json.loads(raw.decode("utf-8") if raw else "{}")
+                payload = _loads(raw or b"{}")
                 text = str(payload.get("text") or payload.get("input") or "")
                 audio_prompt_path = payload.get("audio_prompt_path") or payload.get("voice")
                 if payload.get("exaggeration") is not None:
@@ -201,6 +452,7 @@ class Handler(BaseHTTPRequestHandler):
                     cfg_weight = float(payload.get("cfg_weight"))
                 if payload.get("chunk_size") is not None:
                     chunk_size = int(payload.get("chunk_size"))
+                stream = bool(payload.get("stream"))
             except Exception as e:
                 self._send(400, f"invalid json: {e}\n".encode("utf-8"))
                 return
@@ -212,6 +464,34 @@ class Handler(BaseHTTPRequestHandler):
             self._send(400, b"missing text\n")
             return
 
+        if audio_prompt_path is not None and not isinstance(audio_prompt_path, str):
+            # Anything else would reach os.stat/open, which treat an int (or bool) as an fd.
+            self._send(400, b"voice / audio_prompt_path must be a file path string\n")
+            return
+
+        key: bytes | None = None
+        voice_digest = _voice_digest(audio_prompt_path)
+        if not audio_prompt_path and DEFAULT_CONDS is None:
+            # No built-in voice to restore (or no model yet): the output is in whichever voice
+            # was prepared last, so it can't be cached under the default-voice key.
+            voice_digest = None
+        if voice_digest is not None:
+            key = _cache_key(
+                text, exaggeration, temperature, cfg_weight, chunk_size, audio_prompt_path, voice_digest, _QUANTIZE
+            )
+            cached = CACHE.get(key)
+            if cached is not None:
+                self._send(200, cached, content_type="audio/wav")
+                return
+            if DISK_CACHE.enabled and _send_file(self, DISK_CACHE.path_for(key), "audio/wav"):
+                return
+
+        if stream:
+            self._stream_wav(
+                key, _generate_chunks(text, audio_prompt_path, exaggeration, temperature, cfg_weight, chunk_size)
+            )
+            return
+
         try:
             wav = _generate_wav(text, audio_prompt_path, exaggeration, temperature, cfg_weight, chunk_size)
             wav = wav.detach().cpu()
@@ -221,21 +501,19 @@ class Handler(BaseHTTPRequestHandler):
             self._send(500, f"tts failed: {e}\n".encode("utf-8"))
             return
 
-        try:
-            import torchaudio
-        except Exception as e:
-            self._send(500, f"torchaudio not available: {e}\n".encode("utf-8"))
-            return
-
-        with tempfile.TemporaryDirectory(prefix="agentloop-chatterbox-") as tmpdir:
-            out_path = os.path.join(tmpdir, "out.wav")
-            sr = int(MODEL_SR or 24000)
-            torchaudio.save(out_path, wav, sr)
-            with open(out_path, "rb") as f:
-                audio = f.read()
+        # (channels, samples) -> interleaved PCM16 behind a 44-byte header; no temp file.
+        channels = wav.size(0)
+        pcm = _pcm16(wav.t())
+        audio = _wav_header(len(pcm) // (2 * channels), int(MODEL_SR or 24000), channels) + pcm
 
+        if key is not None:
+            CACHE.put(key, audio)
+            DISK_CACHE.put(key, audio)
         self._send(200, audio, content_type="audio/wav")
 
+    _GET_ROUTES = {"/health": _h_health, "/": _h_root}
+    _POST_ROUTES = {"/tts": _h_tts}
+
     def log_message(self, fmt: str, *args) -> None:  # noqa: A003
         msg = fmt % args
         print(f"[chatterbox] {self.address_string()} {msg}")
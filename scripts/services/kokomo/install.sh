@@ -65,7 +65,7 @@ if [[ -x "$PY" && "$FORCE" -ne 1 ]]; then
     fi
 
     echo "[kokomo] upgrading mlx-audio in: $VENV_DIR" >&2
-    uv pip install --python "$PY" --upgrade "mlx-audio[tts]"
+    uv pip install --python "$PY" --upgrade "mlx-audio[tts]" orjson
     echo "[kokomo] ensuring spaCy English model (en_core_web_sm) is installed" >&2
     if ! "$PY" -c "import spacy; spacy.load('en_core_web_sm')" >/dev/null 2>&1; then
       if "$PY" -m spacy download en_core_web_sm >/dev/null 2>&1; then
@@ -123,7 +123,7 @@ echo "[kokomo] creating venv in $VENV_DIR" >&2
 uv venv --seed --python python3 "$VENV_DIR"
 
 echo "[kokomo] installing mlx-audio" >&2
-uv pip install --python "$VENV_DIR/bin/python" "mlx-audio[tts]"
+uv pip install --python "$VENV_DIR/bin/python" "mlx-audio[tts]" orjson
 
 echo "[kokomo] ensuring spaCy English model (en_core_web_sm) is installed" >&2
 if ! "$VENV_DIR/bin/python" -c "import spacy; spacy.load('en_core_web_sm')" >/dev/null 2>&1; then
@@ -2,31 +2,79 @@
 from __future__ import annotations
 
 import argparse
-import glob
-import json
+import importlib.util
 import os
-import shutil
+import re
 import subprocess
 import sys
 import tempfile
+import threading
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+# Run as a script: put scripts/services on the path for the helpers in _shared/.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-def _pick_generator() -> list[str] | None:
-    # CLI names vary by version; try common candidates.
-    candidates = ("mlx_audio.tts.generate", "mlx-audio.generate", "mlx_audio.generate")
+from _shared.jsonio import dumps as _dumps, loads as _loads  # noqa: E402
+from _shared.wavcache import DiskWavCache, WavCache, cache_key as _cache_key, send_file as _send_file  # noqa: E402
+from worker import LANG_CODE, SPEED, VOICE  # noqa: E402
 
-    venv_bin = os.path.dirname(sys.executable)
-    for name in candidates:
-        direct = os.path.join(venv_bin, name)
-        if os.path.isfile(direct) and os.access(direct, os.X_OK):
-            return [direct]
 
-    for name in candidates:
-        path = shutil.which(name)
-        if path:
-            return [path]
-    return None
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+
+
+# Install hints for worker failures, first match wins.
+_DEPS_HINT = "\nHint: your venv is missing runtime deps. Run:\n  bun run kokomo:install -- --yes --upgrade\n"
+_INSTALL_HINT = "\nHint: mlx-audio is not installed in this venv. Run:\n  bun run kokomo:install -- --yes\n"
+_HINTS = (
+    (re.compile(r"No module named '?mlx_audio\b"), _INSTALL_HINT),
+    (re.compile(r"No module named '?(?:soundfile|scipy|sounddevice|loguru|misaki)\b"), _DEPS_HINT),
+    (re.compile(r"No module named pip\b"), "\nHint: your venv is missing pip. Run:\n  bun run kokomo:install -- --yes --force\n"),
+)
+
+
+def _hint_for(msg: str) -> str:
+    return next((hint for rx, hint in _HINTS if rx.search(msg)), "")
+
+
+def _spawn_worker(model: str) -> subprocess.Popen:
+    # The worker preloads `model` so the first request doesn't pay the load cost.
+    return subprocess.Popen(
+        [sys.executable, WORKER_PATH, model],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        bufsize=0,
+    )
+
+
+def _read_exact(f, n: int) -> bytes:
+    chunks = []
+    while n > 0:
+        chunk = f.read(n)
+        if not chunk:
+            raise EOFError("kokomo worker exited")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def _worker_generate(httpd, text: str, model: str) -> tuple[bool, bytes]:
+    request = _dumps({"text": text, "model": model})
+    with httpd.lock:
+        worker = httpd.worker
+        if worker.poll() is not None:
+            print(f"[kokomo] worker exited (code={worker.returncode}); restarting")
+            worker = httpd.worker = _spawn_worker(httpd.model)
+        try:
+            worker.stdin.write(str(len(request)).encode("ascii") + b"\n" + request)
+            header = worker.stdout.readline()
+            if not header:
+                raise EOFError("kokomo worker exited")
+            status, _, size = header.decode("ascii").partition(" ")
+            body = _read_exact(worker.stdout, int(size))
+        except (BrokenPipeError, EOFError, ValueError) as e:
+            worker.kill()
+            return False, f"kokomo worker failed: {e}".encode("utf-8")
+    return status == "ok", body
 
 
 class Handler(BaseHTTPRequestHandler):
@@ -39,20 +87,22 @@ class Handler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(body)
 
-    def do_GET(self) -> None:  # noqa: N802
-        if self.path == "/health":
-            self._send(200, b"ok\n")
-            return
-        if self.path == "/":
-            self._send(200, b"agentloop kokomo mlx tts server\n")
-            return
+    def _h_health(self) -> None:
+        self._send(200, b"ok\n")
+
+    def _h_root(self) -> None:
+        self._send(200, b"agentloop kokomo mlx tts server\n")
+
+    def _h_not_found(self) -> None:
         self._send(404, b"not found\n")
 
+    def do_GET(self) -> None:  # noqa: N802
+        self._GET_ROUTES.get(self.path, Handler._h_not_found)(self)
+
     def do_POST(self) -> None:  # noqa: N802
-        if self.path != "/tts":
-            self._send(404, b"not found\n")
-            return
+        self._POST_ROUTES.get(self.path, Handler._h_not_found)(self)
 
+    def _h_tts(self) -> None:
         length = int(self.headers.get("content-length") or "0")
         raw = self.rfile.read(length) if length > 0 else b""
         content_type = (self.headers.get("content-type") or "").lower()
@@ -62,7 +112,7 @@ class Handler(BaseHTTPRequestHandler):
 
         if "application/json" in content_type:
             try:
-                payload = json.loads(raw.decode("utf-8") if raw else "{}")
+                payload = _loads(raw or b"{}")
                 text = str(payload.get("text") or payload.get("input") or "")
                 model = str(payload.get("model") or model)
             except Exception as e:
@@ -76,115 +126,30 @@ class Handler(BaseHTTPRequestHandler):
             self._send(400, b"missing text\n")
             return
 
-        generator = self.server.generator  # type: ignore[attr-defined]
-        if not generator:
-            self._send(
-                500,
-                b"mlx-audio generator not found. Install mlx-audio in your venv.\n",
-            )
+        cache: WavCache = self.server.cache  # type: ignore[attr-defined]
+        # The worker's voice settings come from the same env; a persisted WAV must not outlive them.
+        key = _cache_key(text, model, VOICE, LANG_CODE, SPEED)
+        cached = cache.get(key)
+        if cached is not None:
+            self._send(200, cached, content_type="audio/wav")
+            return
+        disk_cache: DiskWavCache = self.server.disk_cache  # type: ignore[attr-defined]
+        if disk_cache.enabled and _send_file(self, disk_cache.path_for(key), "audio/wav"):
             return
 
-        with tempfile.TemporaryDirectory(prefix="agentloop-kokomo-") as tmpdir:
-            out_path = os.path.join(tmpdir, "out.wav")
-            file_prefix = os.path.join(tmpdir, "out")
-
-            cmd = [
-                *generator,
-                "--model",
-                model,
-                "--text",
-                text,
-                "--file_prefix",
-                file_prefix,
-                "--audio_format",
-                "wav",
-                "--join_audio",
-            ]
-            try:
-                completed = subprocess.run(
-                    cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                )
-                stdout_text = (completed.stdout or b"").decode("utf-8", errors="replace").strip()
-                stderr_text = (completed.stderr or b"").decode("utf-8", errors="replace").strip()
-            except subprocess.CalledProcessError as e:
-                msg = (e.stderr or e.stdout or b"").decode("utf-8", errors="replace")
-                hint = ""
-                if "No module named pip" in msg:
-                    hint = (
-                        "\nHint: your venv is missing pip. Run:\n"
-                        "  bun run kokomo:install -- --yes --force\n"
-                    )
-                if "No module named 'soundfile'" in msg or "No module named soundfile" in msg:
-                    hint = (
-                        "\nHint: your venv is missing runtime deps. Run:\n"
-                        "  bun run kokomo:install -- --yes --upgrade\n"
-                    )
-                if "No module named 'scipy'" in msg or "No module named scipy" in msg:
-                    hint = (
-                        "\nHint: your venv is missing runtime deps. Run:\n"
-                        "  bun run kokomo:install -- --yes --upgrade\n"
-                    )
-                if "No module named 'sounddevice'" in msg or "No module named sounddevice" in msg:
-                    hint = (
-                        "\nHint: your venv is missing runtime deps. Run:\n"
-                        "  bun run kokomo:install -- --yes --upgrade\n"
-                    )
-                if "No module named 'loguru'" in msg or "No module named loguru" in msg:
-                    hint = (
-                        "\nHint: your venv is missing runtime deps. Run:\n"
-                        "  bun run kokomo:install -- --yes --upgrade\n"
-                    )
-                if "No module named 'misaki'" in msg or "No module named misaki" in msg:
-                    hint = (
-                        "\nHint: your venv is missing runtime deps. Run:\n"
-                        "  bun run kokomo:install -- --yes --upgrade\n"
-                    )
-                self._send(
-                    500,
-                    (
-                        "tts failed\n"
-                        f"command: {' '.join(cmd)}\n\n"
-                        f"{msg}\n{hint}"
-                    ).encode("utf-8"),
-                )
-                return
-
-            produced = None
-            if os.path.exists(out_path):
-                produced = out_path
-            else:
-                candidates: list[str] = []
-                candidates.extend(glob.glob(f"{file_prefix}*.wav"))
-                candidates.extend(glob.glob(os.path.join(tmpdir, "*.wav")))
-                if candidates:
-                    produced = sorted(candidates)[-1]
-
-            if not produced or not os.path.exists(produced):
-                files = []
-                try:
-                    files = sorted(os.listdir(tmpdir))
-                except Exception:
-                    files = []
-                self._send(
-                    500,
-                    (
-                        "tts failed: no output wav produced\n"
-                        f"tmpdir: {tmpdir}\n"
-                        f"files: {files}\n"
-                        f"stdout: {stdout_text if stdout_text else '(empty)'}\n"
-                        f"stderr: {stderr_text if stderr_text else '(empty)'}\n"
-                    ).encode("utf-8"),
-                )
-                return
+        ok, body = _worker_generate(self.server, text, model)
+        if not ok:
+            msg = body.decode("utf-8", errors="replace")
+            hint = _hint_for(msg)
+            self._send(500, f"tts failed (model={model})\n\n{msg}\n{hint}".encode("utf-8"))
+            return
 
-            try:
-                with open(produced, "rb") as f:
-                    wav = f.read()
-            except Exception as e:
-                self._send(500, f"failed to read output: {e}\n".encode("utf-8"))
-                return
+        cache.put(key, body)
+        disk_cache.put(key, body)
+        self._send(200, body, content_type="audio/wav")
 
-        self._send(200, wav, content_type="audio/wav")
+    _GET_ROUTES = {"/health": _h_health, "/": _h_root}
+    _POST_ROUTES = {"/tts": _h_tts}
 
     def log_message(self, fmt: str, *args) -> None:  # noqa: A003
         # Keep logs terse; engine will capture stdout/stderr anyway.
@@ -202,16 +167,19 @@ def main() -> int:
     )
     args = ap.parse_args()
 
-    generator = _pick_generator()
-    if not generator:
-        print(
-            "[kokomo] WARNING: no mlx-audio generator binary found on PATH. "
-            "Did you activate the venv and install mlx-audio?"
-        )
-
+    if importlib.util.find_spec("mlx_audio") is None:
+        # The worker runs under this same interpreter, so it won't find mlx-audio either.
+        print("[kokomo] WARNING: mlx-audio is not installed in this venv. Run: bun run kokomo:install -- --yes")
     httpd: ThreadingHTTPServer = ThreadingHTTPServer((args.host, args.port), Handler)
     httpd.model = args.model  # type: ignore[attr-defined]
-    httpd.generator = generator  # type: ignore[attr-defined]
+    httpd.worker = _spawn_worker(args.model)  # type: ignore[attr-defined]
+    httpd.lock = threading.Lock()  # type: ignore[attr-defined]
+    cache_mb = int(os.environ.get("KOKOMO_CACHE_MB", "256"))
+    httpd.cache = WavCache(512, cache_mb * 1024 * 1024)  # type: ignore[attr-defined]
+    httpd.disk_cache = DiskWavCache(  # type: ignore[attr-defined]
+        os.path.join(tempfile.gettempdir(), "agentloop-tts-cache", "kokomo"),
+        int(os.environ.get("KOKOMO_DISK_CACHE_MB", "1024")) * 1024 * 1024,
+    )
     print(f"[kokomo] listening on http://{args.host}:{args.port} (model={args.model})")
     httpd.serve_forever()
     return 0
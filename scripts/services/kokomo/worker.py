@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Long-lived mlx-audio worker for the kokomo server: imports mlx-audio and loads the
+# model once, then serves requests over stdin/stdout.
+#   request: b"<len>\n" + JSON {"text": ..., "model": ...}
+#   reply:   b"ok <len>\n" + WAV bytes, or b"err <len>\n" + UTF-8 error text
+from __future__ import annotations
+
+import io
+import json
+import os
+import sys
+import traceback
+
+VOICE = os.environ.get("KOKOMO_VOICE", "af_heart")
+LANG_CODE = os.environ.get("KOKOMO_LANG_CODE", "a")
+SPEED = 1.0
+
+_loaded: tuple[str, object] | None = None
+
+
+def _get_model(model_id: str):
+    global _loaded
+    if _loaded is not None and _loaded[0] == model_id:
+        return _loaded[1]
+
+    from mlx_audio.tts.utils import load_model  # type: ignore
+
+    # Only keep one model resident; switching models is rare.
+    _loaded = None
+    model = load_model(model_id)
+    _loaded = (model_id, model)
+    return model
+
+
+def _generate_wav(text: str, model_id: str) -> bytes:
+    import numpy as np
+    import soundfile  # type: ignore
+
+    model = _get_model(model_id)
+    segments = []
+    sample_rate = int(getattr(model, "sample_rate", 24000))
+    for result in model.generate(text=text, voice=VOICE, speed=SPEED, lang_code=LANG_CODE):
+        segments.append(np.asarray(result.audio, dtype=np.float32).reshape(-1))
+        sample_rate = int(getattr(result, "sample_rate", sample_rate))
+
+    if not segments:
+        raise RuntimeError("mlx-audio produced no audio")
+
+    audio = np.concatenate(segments) if len(segments) > 1 else segments[0]
+    audio = np.clip(audio, -1.0, 1.0)
+
+    buf = io.BytesIO()
+    soundfile.write(buf, audio, sample_rate, subtype="PCM_16", format="WAV")
+    return buf.getvalue()
+
+
+def _read_exact(f, n: int) -> bytes:
+    chunks = []
+    while n > 0:
+        chunk = f.read(n)
+        if not chunk:
+            raise EOFError
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def main() -> int:
+    # Keep the protocol channel private: anything mlx-audio prints goes to stderr.
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "wb", buffering=0)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    inp = sys.stdin.buffer
+
+    if len(sys.argv) > 1:
+        try:
+            _get_model(sys.argv[1])
+        except Exception as e:
+            print(f"[kokomo] worker: failed to preload {sys.argv[1]}: {e}", file=sys.stderr)
+
+    while True:
+        header = inp.readline()
+        if not header:
+            return 0
+        try:
+            request = json.loads(_read_exact(inp, int(header)))
+        except EOFError:
+            return 0
+
+        try:
+            body = _generate_wav(str(request.get("text") or ""), str(request.get("model") or ""))
+            status = b"ok"
+        except Exception:
+            body = traceback.format_exc().encode("utf-8")
+            status = b"err"
+
+        out.write(status + b" " + str(len(body)).encode("ascii") + b"\n" + body)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
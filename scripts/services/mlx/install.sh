@@ -70,7 +70,7 @@ echo "[mlx] creating venv in $VENV_DIR" >&2
 uv venv --seed --python python3 "$VENV_DIR"
 
 echo "[mlx] installing mlx-lm" >&2
-uv pip install --python "$VENV_DIR/bin/python" --upgrade mlx-lm
+uv pip install --python "$VENV_DIR/bin/python" --upgrade mlx-lm orjson
 
 echo "[mlx] done" >&2
 echo "[mlx] run server: bun run mlx:server" >&2
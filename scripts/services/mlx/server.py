@@ -2,12 +2,24 @@
 from __future__ import annotations
 
 import argparse
-import json
+import contextlib
+import functools
 import os
+import queue
+import shutil
+import socket
+import sys
 import threading
 import time
+from concurrent.futures import Future
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+# Run as a script: put scripts/services on the path for the helpers in _shared/.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from _shared.jsonio import dumps as _dumps, loads as _loads  # noqa: E402
+from _shared import workers  # noqa: E402
+
 
 def _load_mlx_model(model_id: str):
     try:
@@ -17,10 +29,57 @@ def _load_mlx_model(model_id: str):
             "mlx-lm is not installed in this venv. Run: bun run mlx:install -- --yes"
         ) from e
 
+    bits = int(os.environ.get("MLX_QUANTIZE") or "0")
+    if bits and not _is_quantized(model_id):
+        model_id = _quantize_to_cache(model_id, bits)
+
     model, tokenizer = load(model_id)
     return model, tokenizer
 
 
+def _is_quantized(model_id: str) -> bool:
+    try:
+        from mlx_lm.utils import get_model_path, load_config  # type: ignore
+
+        path = get_model_path(model_id)
+        # Newer mlx-lm returns (path, hf_repo).
+        if isinstance(path, tuple):
+            path = path[0]
+        return "quantization" in load_config(path)
+    except Exception as e:
+        # Can't tell; leave the model alone rather than re-quantizing, but say so: MLX_QUANTIZE
+        # was set explicitly.
+        print(f"[mlx] MLX_QUANTIZE ignored for {model_id}: could not read its config ({e})")
+        return True
+
+
+def _quantize_to_cache(model_id: str, bits: int) -> str:
+    cache_root = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    out_dir = os.path.join(cache_root, "agentloop", "mlx-quantized", f"{model_id.replace('/', '--')}-q{bits}")
+    if os.path.isfile(os.path.join(out_dir, "config.json")):
+        return out_dir
+
+    try:
+        from mlx_lm import convert  # type: ignore
+    except Exception:
+        from mlx_lm.convert import convert  # type: ignore
+
+    print(f"[mlx] quantizing {model_id} to {bits}-bit (one-time): {out_dir}")
+    # convert() refuses existing paths, so build next to the target and rename into place.
+    tmp_dir = f"{out_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+    convert(model_id, mlx_path=tmp_dir, quantize=True, q_bits=bits, q_group_size=64)
+    try:
+        os.replace(tmp_dir, out_dir)
+    except OSError:
+        # Another worker finished first; keep its copy.
+        if not os.path.isfile(os.path.join(out_dir, "config.json")):
+            raise
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return out_dir
+
+
 def _build_prompt(tokenizer, messages: list[dict]) -> str:
     # Prefer HF chat template if the tokenizer supports it.
     try:
@@ -40,6 +99,73 @@ def _build_prompt(tokenizer, messages: list[dict]) -> str:
     return "\n".join(parts)
 
 
+_TAIL_PROBE = "\x00agentloop-tail\x00"
+
+
+class ChatTemplateCache:
+    # Renders the conversation history once and only formats the new last turn per request.
+    # The wrapper the template puts around a final turn is learned per role by rendering
+    # probe conversations; templates whose output isn't "history + tail" (e.g. ones that
+    # move the system prompt into the last user turn) fall back to a full render.
+    def __init__(self, tokenizer, max_entries: int = 64):
+        self.tokenizer = tokenizer
+        self._tails: dict[str, tuple[str, str, bool] | None] = {}
+        self._prefix = functools.lru_cache(maxsize=max_entries)(self._render_prefix)
+
+    def _render_prefix(self, history: tuple[tuple[str, str], ...]) -> str:
+        messages = [{"role": role, "content": content} for role, content in history]
+        return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+
+    def _learn_tail(self, role: str) -> tuple[str, str, bool] | None:
+        # Returns (before, after, strip): the text around the last turn's content, and
+        # whether the template trims that content (Llama 3 does).
+        apply = self.tokenizer.apply_chat_template
+        probes = [
+            [{"role": "system", "content": "s"}, {"role": "user", "content": "u"}, {"role": "assistant", "content": "a"}],
+            [{"role": "user", "content": "u"}, {"role": "assistant", "content": "a"}],
+        ]
+        padded = f" \n{_TAIL_PROBE}\n "
+        tail: tuple[str, str, bool] | None = None
+        for history in probes:
+            if history[-1]["role"] == role:
+                history = history[:-1]
+            head = apply(history, tokenize=False, add_generation_prompt=False)
+            full = apply(history + [{"role": role, "content": padded}], tokenize=False, add_generation_prompt=True)
+            if not full.startswith(head) or full.count(_TAIL_PROBE) != 1:
+                return None
+            rest = full[len(head) :]
+            strip = padded not in rest
+            before, after = rest.split(_TAIL_PROBE if strip else padded)
+            if tail is not None and tail != (before, after, strip):
+                return None
+            tail = (before, after, strip)
+        return tail
+
+    def render(self, messages: list[dict]) -> str:
+        if len(messages) < 2 or not callable(getattr(self.tokenizer, "apply_chat_template", None)):
+            return _build_prompt(self.tokenizer, messages)
+        # Only plain {"role", "content": str} turns are safe to re-render from the history key.
+        if any(set(m) - {"role", "content"} or not isinstance(m.get("content"), str) for m in messages):
+            return _build_prompt(self.tokenizer, messages)
+
+        last = messages[-1]
+        role = str(last.get("role") or "user")
+        try:
+            if role not in self._tails:
+                try:
+                    self._tails[role] = self._learn_tail(role)
+                except Exception:
+                    self._tails[role] = None
+            tail = self._tails[role]
+            if tail is None:
+                return _build_prompt(self.tokenizer, messages)
+            head = self._prefix(tuple((str(m.get("role") or "user"), m["content"]) for m in messages[:-1]))
+        except Exception:
+            return _build_prompt(self.tokenizer, messages)
+        before, after, strip = tail
+        return head + before + (last["content"].strip() if strip else last["content"]) + after
+
+
 def _generate(model, tokenizer, prompt: str, max_tokens: int, temperature: float, top_p: float) -> str:
     from mlx_lm import generate  # type: ignore
 
@@ -73,12 +199,246 @@ def _generate(model, tokenizer, prompt: str, max_tokens: int, temperature: float
     raise TypeError(f"mlx-lm generate() argument mismatch (tried {len(candidates)} variants)") from last_err
 
 
+def _cache_api():
+    # mlx-lm pieces needed for prompt-cache reuse; None on versions that predate them.
+    try:
+        from mlx_lm import stream_generate  # type: ignore
+        from mlx_lm.models.cache import can_trim_prompt_cache, make_prompt_cache, trim_prompt_cache  # type: ignore
+        from mlx_lm.sample_utils import make_sampler  # type: ignore
+    except Exception:
+        return None
+    return stream_generate, make_prompt_cache, can_trim_prompt_cache, trim_prompt_cache, make_sampler
+
+
+def _common_prefix(a: list[int], b: list[int]) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class PromptCacheStore:
+    # Recently used KV caches, keyed by the tokens they already hold. A request resumes from
+    # the entry sharing its longest token prefix (e.g. the same system prompt and history)
+    # and only prefills the rest. Entries are taken out while in use, so concurrent
+    # requests never share one.
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: list[tuple[list[int], list]] = []
+        self._lock = threading.Lock()
+
+    def take(self, model, tokens: list[int], api) -> tuple[list, int]:
+        _, make_prompt_cache, can_trim_prompt_cache, trim_prompt_cache, _ = api
+        with self._lock:
+            best, best_len = -1, 0
+            for i, (cached, _) in enumerate(self._entries):
+                n = _common_prefix(cached, tokens)
+                if n > best_len:
+                    best, best_len = i, n
+
+            # Always leave at least one prompt token to run so generation starts from fresh logits.
+            best_len = min(best_len, len(tokens) - 1)
+            if best < 0 or best_len <= 0:
+                return make_prompt_cache(model), 0
+
+            cached, cache = self._entries.pop(best)
+        excess = len(cached) - best_len
+        if excess:
+            if not can_trim_prompt_cache(cache):
+                return make_prompt_cache(model), 0
+            trim_prompt_cache(cache, excess)
+        return cache, best_len
+
+    def put(self, tokens: list[int], cache: list) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries.append((tokens, cache))
+            del self._entries[: -self.max_entries]
+
+
+def _encode_prompt(tokenizer, prompt: str) -> list[int]:
+    # Match mlx-lm: don't add a second BOS when the chat template already emitted one.
+    bos = getattr(tokenizer, "bos_token", None)
+    add_special_tokens = bos is None or not prompt.startswith(bos)
+    return list(tokenizer.encode(prompt, add_special_tokens=add_special_tokens))
+
+
+def _stream_cached(server, prompt: str, max_tokens: int, temperature: float, top_p: float):
+    # Yields text segments.
+    stream_generate, *_, make_sampler = server.cache_api
+    tokens = _encode_prompt(server.tokenizer, prompt)
+    cache, reused = server.prompt_cache.take(server.model, tokens, server.cache_api)
+
+    generated: list[int] = []
+    for resp in stream_generate(
+        server.model,
+        server.tokenizer,
+        tokens[reused:],
+        max_tokens=max_tokens,
+        sampler=make_sampler(temp=temperature, top_p=top_p),
+        prompt_cache=cache,
+    ):
+        generated.append(resp.token)
+        yield resp.text
+
+    # The last sampled token is never fed back, so trust the cache's own offset.
+    held = tokens + generated
+    offset = getattr(cache[0], "offset", None) if cache else None
+    if isinstance(offset, int) and 0 < offset <= len(held):
+        server.prompt_cache.put(held[:offset], cache)
+
+
+def _generate_segments(server, prompt: str, max_tokens: int, temperature: float, top_p: float):
+    # Yields text as it is decoded (a single segment on mlx-lm versions without prompt caches).
+    # Only call from the batch thread, which owns the model.
+    if server.cache_api is not None:
+        yield from _stream_cached(server, prompt, max_tokens, temperature, top_p)
+    else:
+        yield _generate(server.model, server.tokenizer, prompt, max_tokens, temperature, top_p)
+
+
+def _batch_api():
+    # mlx-lm's batched decoder (newer versions only); None when unavailable.
+    try:
+        try:
+            from mlx_lm import batch_generate  # type: ignore
+        except ImportError:
+            from mlx_lm.generate import batch_generate  # type: ignore
+        from mlx_lm.sample_utils import make_sampler  # type: ignore
+    except Exception:
+        return None
+    return batch_generate, make_sampler
+
+
+class GenerationJob:
+    # One queued completion. Streaming jobs push segments to `out` and watch `cancel`;
+    # the others resolve `future` with the full text.
+    def __init__(
+        self,
+        prompt: str,
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        out: queue.Queue | None = None,
+        cancel: threading.Event | None = None,
+    ):
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.out = out
+        self.cancel = cancel
+        self.future: Future = Future()
+
+
+def _run_stream(server, job: GenerationJob) -> None:
+    segments = _generate_segments(server, job.prompt, job.max_tokens, job.temperature, job.top_p)
+    try:
+        for text in segments:
+            if job.cancel is not None and job.cancel.is_set():
+                break
+            job.out.put(("text", text))
+        job.out.put(("done", None))
+    except Exception as e:
+        job.out.put(("error", e))
+    finally:
+        segments.close()
+
+
+def _run_single(server, job: GenerationJob) -> None:
+    if job.out is not None:
+        _run_stream(server, job)
+        return
+    try:
+        job.future.set_result("".join(_generate_segments(server, job.prompt, job.max_tokens, job.temperature, job.top_p)))
+    except Exception as e:
+        job.future.set_exception(e)
+
+
+def _run_batch(server, jobs: list[GenerationJob]) -> bool:
+    # All jobs share max_tokens and sampling params, so one decode loop serves them all.
+    batch_generate, make_sampler = server.batch_api
+    first = jobs[0]
+    try:
+        prompts = [_encode_prompt(server.tokenizer, j.prompt) for j in jobs]
+        resp = batch_generate(
+            server.model,
+            server.tokenizer,
+            prompts,
+            max_tokens=first.max_tokens,
+            sampler=make_sampler(temp=first.temperature, top_p=first.top_p),
+        )
+        texts = list(resp.texts)
+    except Exception as e:
+        print(f"[mlx] batch_generate failed ({e}); running {len(jobs)} requests one at a time")
+        return False
+    for job, text in zip(jobs, texts):
+        job.future.set_result(text)
+    return True
+
+
+def _gpu_stream():
+    # Keep this thread's MLX work on the GPU stream. A no-op where mlx.core isn't importable or
+    # has no GPU backend (Linux CPU wheels), where entering mx.stream(mx.gpu) would raise.
+    try:
+        import mlx.core as mx  # type: ignore
+
+        # Older releases only have the Metal check; is_available also covers CUDA builds.
+        has_gpu = mx.is_available(mx.gpu) if hasattr(mx, "is_available") else mx.metal.is_available()
+    except Exception:
+        return contextlib.nullcontext()
+    return mx.stream(mx.gpu) if has_gpu else contextlib.nullcontext()
+
+
+def _batch_loop(server) -> None:
+    # Sole owner of the model. Takes whatever piled up while the previous round ran and
+    # decodes compatible non-streaming requests together; the rest run one at a time.
+    with _gpu_stream():
+        while True:
+            jobs = [server.inbox.get()]
+            while len(jobs) < server.batch_size:
+                try:
+                    jobs.append(server.inbox.get_nowait())
+                except queue.Empty:
+                    break
+
+            groups: dict[tuple[int, float, float], list[GenerationJob]] = {}
+            singles: list[GenerationJob] = []
+            for job in jobs:
+                if job.out is None and server.batch_api is not None:
+                    groups.setdefault((job.max_tokens, job.temperature, job.top_p), []).append(job)
+                else:
+                    singles.append(job)
+
+            for group in groups.values():
+                if len(group) == 1 or not _run_batch(server, group):
+                    singles.extend(group)
+            for job in singles:
+                _run_single(server, job)
+
+
 class MlxServer(ThreadingHTTPServer):
-    def __init__(self, addr, handler, model_id: str):
+    def __init__(self, addr, handler, model_id: str, reuse_port: bool = False):
+        # With --workers, every process binds the same port and the kernel spreads connections.
+        self.reuse_port = reuse_port
         super().__init__(addr, handler)
         self.model_id = model_id
         self.model, self.tokenizer = _load_mlx_model(model_id)
-        self.lock = threading.Lock()
+        self.chat_template = ChatTemplateCache(self.tokenizer)
+        self.cache_api = _cache_api()
+        self.batch_api = _batch_api()
+        self.prompt_cache = PromptCacheStore(int(os.environ.get("MLX_PROMPT_CACHE", "4")))
+        # HTTP threads only parse and write; all model work goes through this inbox.
+        self.batch_size = max(1, int(os.environ.get("MLX_BATCH", "8")))
+        self.inbox: queue.Queue = queue.Queue()
+        threading.Thread(target=_batch_loop, args=(self,), name="mlx-batch", daemon=True).start()
+
+    def server_bind(self) -> None:
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
 
 
 class Handler(BaseHTTPRequestHandler):
@@ -91,47 +451,90 @@ class Handler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(body)
 
-    def do_GET(self) -> None:  # noqa: N802
-        if self.path == "/health":
-            self._send(200, b"ok\n", content_type="text/plain; charset=utf-8")
-            return
+    def _stream_completion(self, prompt: str, max_tokens: int, temperature: float, top_p: float) -> None:
+        # OpenAI-style server-sent events: one chat.completion.chunk per decoded segment.
+        now = int(time.time())
+        base = {
+            "id": f"chatcmpl-{now}",
+            "object": "chat.completion.chunk",
+            "created": now,
+            "model": self.server.model_id,  # type: ignore[attr-defined]
+        }
 
-        if self.path in ("/v1/models", "/models"):
-            model_id = self.server.model_id  # type: ignore[attr-defined]
-            payload = {"object": "list", "data": [{"id": model_id, "object": "model"}]}
-            self._send(200, json.dumps(payload).encode("utf-8"))
-            return
+        def event(delta: dict, finish_reason: str | None = None) -> bytes:
+            chunk = dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}])
+            return b"data: " + _dumps(chunk) + b"\n\n"
 
-        self._send(404, json.dumps({"error": "not found"}).encode("utf-8"))
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("cache-control", "no-cache")
+        self.end_headers()
+
+        out: queue.Queue = queue.Queue()
+        cancel = threading.Event()
+        self.server.inbox.put(GenerationJob(prompt, max_tokens, temperature, top_p, out, cancel))  # type: ignore[attr-defined]
+        try:
+            self.wfile.write(event({"role": "assistant"}))
+            while True:
+                kind, value = out.get()
+                if kind == "done":
+                    break
+                if kind == "error":
+                    err = {"error": f"generation failed: {value}"}
+                    self.wfile.write(b"data: " + _dumps(err) + b"\n\n")
+                    return
+                if value:
+                    self.wfile.write(event({"content": value}))
+                    self.wfile.flush()
+            self.wfile.write(event({}, "stop") + b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # Stop decoding as soon as the client goes away.
+            cancel.set()
+
+    def _h_health(self) -> None:
+        self._send(200, b"ok\n", content_type="text/plain; charset=utf-8")
+
+    def _h_models(self) -> None:
+        model_id = self.server.model_id  # type: ignore[attr-defined]
+        payload = {"object": "list", "data": [{"id": model_id, "object": "model"}]}
+        self._send(200, _dumps(payload))
+
+    def _h_not_found(self) -> None:
+        self._send(404, _dumps({"error": "not found"}))
+
+    def do_GET(self) -> None:  # noqa: N802
+        self._GET_ROUTES.get(self.path, Handler._h_not_found)(self)
 
     def do_POST(self) -> None:  # noqa: N802
-        if self.path not in ("/v1/chat/completions", "/chat/completions"):
-            self._send(404, json.dumps({"error": "not found"}).encode("utf-8"))
-            return
+        self._POST_ROUTES.get(self.path, Handler._h_not_found)(self)
 
+    def _h_chat_completions(self) -> None:
         length = int(self.headers.get("content-length") or "0")
         raw = self.rfile.read(length) if length > 0 else b"{}"
         try:
-            payload = json.loads(raw.decode("utf-8"))
+            payload = _loads(raw)
         except Exception as e:
-            self._send(400, json.dumps({"error": f"invalid json: {e}"}).encode("utf-8"))
+            self._send(400, _dumps({"error": f"invalid json: {e}"}))
             return
 
         messages = payload.get("messages") or []
         if not isinstance(messages, list) or not messages:
-            self._send(400, json.dumps({"error": "missing messages[]"}).encode("utf-8"))
+            self._send(400, _dumps({"error": "missing messages[]"}))
+            return
+        if not all(isinstance(m, dict) for m in messages):
+            self._send(400, _dumps({"error": "messages[] entries must be objects"}))
             return
 
         model_id = str(payload.get("model") or self.server.model_id)  # type: ignore[attr-defined]
         if model_id != self.server.model_id:  # type: ignore[attr-defined]
             self._send(
                 400,
-                json.dumps(
+                _dumps(
                     {
                         "error": "this server is started with a single model; restart with MLX_MODEL to change",
                         "model": self.server.model_id,  # type: ignore[attr-defined]
                     }
-                ).encode("utf-8"),
+                ),
             )
             return
 
@@ -140,11 +543,21 @@ class Handler(BaseHTTPRequestHandler):
         top_p = float(payload.get("top_p") or float(os.environ.get("MLX_TOP_P", "0.9")))
 
         try:
-            prompt = _build_prompt(self.server.tokenizer, messages)  # type: ignore[attr-defined]
-            with self.server.lock:  # type: ignore[attr-defined]
-                content = _generate(self.server.model, self.server.tokenizer, prompt, max_tokens, temperature, top_p)  # type: ignore[attr-defined]
+            # Chat templates can still reject well-formed dicts (e.g. roles out of order).
+            prompt = self.server.chat_template.render(messages)  # type: ignore[attr-defined]
         except Exception as e:
-            self._send(500, json.dumps({"error": f"generation failed: {e}"}).encode("utf-8"))
+            self._send(500, _dumps({"error": f"generation failed: {e}"}))
+            return
+        if payload.get("stream"):
+            self._stream_completion(prompt, max_tokens, temperature, top_p)
+            return
+
+        try:
+            job = GenerationJob(prompt, max_tokens, temperature, top_p)
+            self.server.inbox.put(job)  # type: ignore[attr-defined]
+            content = job.future.result()
+        except Exception as e:
+            self._send(500, _dumps({"error": f"generation failed: {e}"}))
             return
 
         now = int(time.time())
@@ -161,13 +574,24 @@ class Handler(BaseHTTPRequestHandler):
                 }
             ],
         }
-        self._send(200, json.dumps(response).encode("utf-8"))
+        self._send(200, _dumps(response))
+
+    _GET_ROUTES = {"/health": _h_health, "/v1/models": _h_models, "/models": _h_models}
+    _POST_ROUTES = {"/v1/chat/completions": _h_chat_completions, "/chat/completions": _h_chat_completions}
 
     def log_message(self, fmt: str, *args) -> None:  # noqa: A003
         msg = fmt % args
         print(f"[mlx] {self.address_string()} {msg}")
 
 
+def _serve(args, reuse_port: bool = False) -> int:
+    print(f"[mlx] loading model: {args.model}")
+    httpd: MlxServer = MlxServer((args.host, args.port), Handler, args.model, reuse_port=reuse_port)
+    print(f"[mlx] listening: http://{args.host}:{args.port} (OpenAI-ish: /v1/chat/completions)")
+    httpd.serve_forever()
+    return 0
+
+
 def main() -> int:
     ap = argparse.ArgumentParser()
     ap.add_argument("--host", default=os.environ.get("MLX_HOST", "127.0.0.1"))
@@ -176,13 +600,10 @@ def main() -> int:
         "--model",
         default=os.environ.get("MLX_MODEL", "mlx-community/Llama-3.2-3B-Instruct-4bit"),
     )
+    ap.add_argument("--workers", type=int, default=int(os.environ.get("MLX_WORKERS", "1")))
     args = ap.parse_args()
 
-    print(f"[mlx] loading model: {args.model}")
-    httpd: MlxServer = MlxServer((args.host, args.port), Handler, args.model)
-    print(f"[mlx] listening: http://{args.host}:{args.port} (OpenAI-ish: /v1/chat/completions)")
-    httpd.serve_forever()
-    return 0
+    return workers.run(args, _serve, "mlx")
 
 
 if __name__ == "__main__":
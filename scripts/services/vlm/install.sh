@@ -71,7 +71,7 @@ echo "[vlm] creating venv in $VENV_DIR" >&2
 uv venv --seed --python python3 "$VENV_DIR"
 
 echo "[vlm] installing deps (mlx-vlm + pillow)" >&2
-uv pip install --python "$VENV_DIR/bin/python" --upgrade mlx-vlm pillow
+uv pip install --python "$VENV_DIR/bin/python" --upgrade mlx-vlm pillow orjson
 
 echo "[vlm] done" >&2
 echo "[vlm] run server: bun run vlm:server" >&2
@@ -3,13 +3,31 @@ from __future__ import annotations
 
 import argparse
 import base64
-import json
+import contextlib
+import gc
+import hashlib
 import os
+import queue
+import shutil
+import socket
+import sys
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import Future
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
 from typing import Any
 
+# Run as a script: put scripts/services on the path for the helpers in _shared/.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from _shared.jsonio import dumps as _dumps, loads as _loads  # noqa: E402
+from _shared import workers  # noqa: E402
+
+
+_NOT_FOUND = _dumps({"error": "not found"})
+
 
 def _load_vlm(model_id: str):
     try:
@@ -20,10 +38,265 @@ def _load_vlm(model_id: str):
             "mlx-vlm is not installed in this venv. Run: bun run vlm:install -- --yes"
         ) from e
 
+    bits = _quant_bits(os.environ.get("VLM_QUANT", ""))
+    if bits and not _is_quantized(model_id):
+        model_id = _quantize_to_cache(model_id, bits)
+
     model, processor = load(model_id)
     return model, processor
 
 
+def _quant_bits(spec: str) -> int:
+    # VLM_QUANT: int4/int8 (or just 4/8); anything else leaves the weights as shipped.
+    spec = spec.strip().lower().removeprefix("int")
+    return int(spec) if spec in ("4", "8") else 0
+
+
+def _is_quantized(model_id: str) -> bool:
+    try:
+        from mlx_vlm.utils import get_model_path, load_config  # type: ignore
+
+        path = get_model_path(model_id)
+        if isinstance(path, tuple):
+            path = path[0]
+        return "quantization" in load_config(path)
+    except Exception as e:
+        # Can't tell; leave the model alone rather than re-quantizing, but say so: VLM_QUANT
+        # was set explicitly.
+        print(f"[vlm] VLM_QUANT ignored for {model_id}: could not read its config ({e})")
+        return True
+
+
+def _quantize_to_cache(model_id: str, bits: int) -> str:
+    cache_root = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    out_dir = os.path.join(cache_root, "agentloop", "vlm-quantized", f"{model_id.replace('/', '--')}-q{bits}")
+    if os.path.isfile(os.path.join(out_dir, "config.json")):
+        return out_dir
+
+    try:
+        from mlx_vlm import convert  # type: ignore
+    except Exception:
+        from mlx_vlm.convert import convert  # type: ignore
+
+    print(f"[vlm] quantizing {model_id} to {bits}-bit (one-time): {out_dir}")
+    # convert() refuses existing paths, so build next to the target and rename into place.
+    tmp_dir = f"{out_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+    convert(model_id, mlx_path=tmp_dir, quantize=True, q_bits=bits, q_group_size=64)
+    try:
+        os.replace(tmp_dir, out_dir)
+    except OSError:
+        # Another worker finished first; keep its copy.
+        if not os.path.isfile(os.path.join(out_dir, "config.json")):
+            raise
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return out_dir
+
+
+def _model_bytes(model) -> int:
+    # Approximate resident size: the sum of the weight arrays.
+    try:
+        from mlx.utils import tree_flatten  # type: ignore
+
+        return sum(int(v.nbytes) for _, v in tree_flatten(model.parameters()))
+    except Exception:
+        return 0
+
+
+def _clear_mlx_cache() -> None:
+    try:
+        import mlx.core as mx  # type: ignore
+
+        clear = getattr(mx, "clear_cache", None) or mx.metal.clear_cache
+        clear()
+    except Exception:
+        pass
+
+
+class ModelEntry:
+    def __init__(self, model_id: str, model, processor):
+        self.model_id = model_id
+        self.model = model
+        self.processor = processor
+        self.nbytes = _model_bytes(model)
+        self.last_used = time.monotonic()
+        # Weights copied out to pageable host memory while idle; None while resident.
+        self.parked: list[tuple[str, Any, Any]] | None = None
+        # Held while generating (see use()) or parking, so neither races a request.
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def use(self):
+        # Exclusive use for one generation, bringing parked weights back first.
+        with self.lock:
+            if self.parked is not None:
+                print(f"[vlm] unparking model: {self.model_id}")
+                self.unpark()
+            try:
+                yield self
+            finally:
+                self.last_used = time.monotonic()
+
+    def park(self) -> None:
+        # Copy the weights into numpy arrays, swap the model's arrays for empty placeholders
+        # and release MLX's buffer cache, so the wired GPU memory goes back to the system.
+        # Call with self.lock held.
+        import mlx.core as mx  # type: ignore
+        import numpy as np
+        from mlx.utils import tree_flatten, tree_unflatten  # type: ignore
+
+        parked = []
+        placeholders = []
+        for name, value in tree_flatten(self.model.parameters()):
+            # numpy has no bfloat16; keep those as raw 16-bit words.
+            raw = value.view(mx.uint16) if value.dtype == mx.bfloat16 else value
+            parked.append((name, np.array(raw), value.dtype))
+            placeholders.append((name, mx.zeros((0,), dtype=value.dtype)))
+        self.model.update(tree_unflatten(placeholders))
+        self.parked = parked
+        gc.collect()
+        _clear_mlx_cache()
+
+    def unpark(self) -> None:
+        # Rebuild the weights from host memory; no disk I/O. Call with self.lock held.
+        import mlx.core as mx  # type: ignore
+        from mlx.utils import tree_unflatten  # type: ignore
+
+        weights = []
+        for name, host, dtype in self.parked or ():
+            value = mx.array(host)
+            weights.append((name, value.view(dtype) if dtype == mx.bfloat16 else value))
+        self.model.update(tree_unflatten(weights))
+        mx.eval(self.model.parameters())
+        self.parked = None
+
+
+class ModelCache:
+    # Loaded models keyed by id, least recently used evicted first once their approximate
+    # weight bytes exceed max_bytes. The most recent model always stays loaded.
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, ModelEntry] = OrderedDict()
+        self._listing: bytes | None = None
+        # Loads in progress; concurrent requests for the same id wait on one Future.
+        self._loading: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def listing(self) -> bytes:
+        # /v1/models body, rebuilt only when the set of loaded models changes.
+        with self._lock:
+            if self._listing is None:
+                data = [{"id": model_id, "object": "model"} for model_id in self._entries]
+                self._listing = _dumps({"object": "list", "data": data})
+            return self._listing
+
+    def peek(self, model_id: str) -> ModelEntry | None:
+        with self._lock:
+            return self._entries.get(model_id)
+
+    def get_or_load(self, model_id: str) -> ModelEntry:
+        with self._lock:
+            entry = self._entries.get(model_id)
+            if entry is not None:
+                self._entries.move_to_end(model_id)
+                return entry
+            pending = self._loading.get(model_id)
+            owner = pending is None
+            if owner:
+                pending = self._loading[model_id] = Future()
+        if not owner:
+            return pending.result()
+
+        # Downloading (and maybe quantizing) can take minutes; peek(), listing() and parking
+        # must not wait on it, so only the insert below holds the cache lock.
+        try:
+            print(f"[vlm] loading model: {model_id}")
+            entry = ModelEntry(model_id, *_load_vlm(model_id))
+        except BaseException as e:
+            with self._lock:
+                del self._loading[model_id]
+            pending.set_exception(e)
+            raise
+        with self._lock:
+            del self._loading[model_id]
+            self._entries[model_id] = entry
+            self._listing = None
+            self._evict()
+        pending.set_result(entry)
+        return entry
+
+    def park_idle(self, idle_s: float) -> None:
+        with self._lock:
+            entries = list(self._entries.values())
+        for entry in entries:
+            if not entry.lock.acquire(blocking=False):
+                continue
+            try:
+                if entry.parked is not None or time.monotonic() - entry.last_used < idle_s:
+                    continue
+                print(f"[vlm] parking idle model: {entry.model_id}")
+                entry.park()
+            except Exception as e:
+                print(f"[vlm] could not park {entry.model_id}: {e}")
+            finally:
+                entry.lock.release()
+
+    def _evict(self) -> None:
+        total = sum(e.nbytes for e in self._entries.values())
+        for model_id in list(self._entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+            entry = self._entries[model_id]
+            if not entry.lock.acquire(blocking=False):
+                continue
+            try:
+                del self._entries[model_id]
+                self._listing = None
+                total -= entry.nbytes
+            finally:
+                entry.lock.release()
+            print(f"[vlm] unloaded model: {model_id}")
+
+
+class ResultCache:
+    # LRU of completions for deterministic (temperature 0) requests, bounded by text bytes.
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict[bytes, str] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: bytes) -> str | None:
+        with self._lock:
+            text = self._items.get(key)
+            if text is not None:
+                self._items.move_to_end(key)
+            return text
+
+    def put(self, key: bytes, text: str) -> None:
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.encode("utf-8"))
+            self._items[key] = text
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted.encode("utf-8"))
+
+
+def _result_key(model_id: str, prompt: str, image_bytes: bytes | None, max_tokens: int, gen_kwargs: dict) -> bytes:
+    h = hashlib.sha256()
+    for part in (model_id, prompt, str(max_tokens), repr(sorted(gen_kwargs.items()))):
+        h.update(part.encode("utf-8") + b"\x00")
+    h.update(image_bytes or b"")
+    return h.digest()
+
+
 def _decode_image_from_message(messages: list[dict[str, Any]]) -> bytes | None:
     # Accept OpenAI-ish content blocks: [{type:'text',...},{type:'image_url', image_url:{url:'data:...'}}]
     for m in reversed(messages):
@@ -53,6 +326,67 @@ def _decode_image_from_message(messages: list[dict[str, Any]]) -> bytes | None:
     return None
 
 
+def _downscale_factor(processor, width: int, height: int) -> float:
+    # How far the image can shrink while staying at least 2x the processor's target size,
+    # so its own final resample still has detail to work with. 1.0 means leave it alone.
+    size = getattr(getattr(processor, "image_processor", None), "size", None)
+    if isinstance(size, int):
+        size = {"height": size, "width": size}
+    if not isinstance(size, dict) or width <= 0 or height <= 0:
+        return 1.0
+    if "height" in size and "width" in size:
+        factor = max(2 * size["width"] / width, 2 * size["height"] / height)
+    elif "shortest_edge" in size:
+        factor = 2 * size["shortest_edge"] / min(width, height)
+    elif "longest_edge" in size:
+        factor = 2 * size["longest_edge"] / max(width, height)
+    elif "max_pixels" in size:
+        factor = 2 * (size["max_pixels"] / (width * height)) ** 0.5
+    else:
+        return 1.0
+    return min(1.0, factor)
+
+
+def _bucket_size(width: int, height: int, buckets: tuple[int, ...]) -> int:
+    # Smallest square bucket that holds the image, else the largest one (the image shrinks).
+    longest = max(width, height)
+    return next((b for b in buckets if b >= longest), buckets[-1])
+
+
+def _letterbox(img, size: int):
+    from PIL import Image  # type: ignore
+
+    # Fit inside a size x size canvas and pad the rest, so dynamic-resolution models only
+    # ever see a few input shapes (and the Metal kernels warmed for them).
+    if img.size == (size, size):
+        return img
+    scale = min(1.0, size / max(img.width, img.height))
+    if scale < 1.0:
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.Resampling.BOX)
+    canvas = Image.new("RGB", (size, size))
+    canvas.paste(img, ((size - img.width) // 2, (size - img.height) // 2))
+    return canvas
+
+
+def _open_image(image_bytes: bytes, processor=None, buckets: tuple[int, ...] = ()):
+    from PIL import Image  # type: ignore
+
+    # BytesIO shares the decoded bytes rather than copying them. Decode here, on the HTTP
+    # thread, and only convert when needed: convert() always returns a copy, even RGB -> RGB.
+    img = Image.open(BytesIO(image_bytes))
+    factor = _downscale_factor(processor, *img.size)
+    if factor < 1.0:
+        target = (max(1, round(img.width * factor)), max(1, round(img.height * factor)))
+        # JPEG can decode straight to a reduced scale; a cheap box filter covers the rest.
+        img.draft("RGB", target)
+        img.load()
+        if img.width > target[0] or img.height > target[1]:
+            img = img.resize(target, Image.Resampling.BOX)
+    img.load()
+    img = img if img.mode == "RGB" else img.convert("RGB")
+    return _letterbox(img, _bucket_size(*img.size, buckets)) if buckets else img
+
+
 def _extract_text(messages: list[dict[str, Any]]) -> str:
     # Prefer a user message string, else concatenate text parts.
     for m in reversed(messages):
@@ -72,22 +406,377 @@ def _extract_text(messages: list[dict[str, Any]]) -> str:
     return ""
 
 
+def _kv_cache_kwargs(kv_dtype: str) -> dict[str, Any]:
+    # VLM_KV_DTYPE -> mlx-vlm's quantized KV cache options. MLX has no fp8 type, so the fp8
+    # spellings map to 8-bit affine quantization, the closest equivalent in size and quality.
+    kv_dtype = kv_dtype.strip().lower()
+    if kv_dtype in ("", "auto"):
+        return {}
+    bits = {"fp8": 8, "fp8_e5m2": 8, "fp8_e4m3": 8, "int8": 8, "8": 8, "int4": 4, "4": 4}.get(kv_dtype)
+    if bits is None:
+        print(f"[vlm] unknown VLM_KV_DTYPE={kv_dtype!r}; using the model's default KV cache")
+        return {}
+    return {"kv_bits": bits, "kv_group_size": 64}
+
+
+def _generate_api():
+    # mlx-vlm's single-request entry point, resolved once at startup: `generate`, or `chat` on
+    # versions old enough to predate KV cache quantization (so it takes no extra kwargs).
+    import mlx_vlm  # type: ignore
+
+    generate = getattr(mlx_vlm, "generate", None)
+    if generate is not None:
+        return generate
+    chat = mlx_vlm.chat
+
+    def _chat(model, processor, prompt, image, max_tokens, temperature, **_):
+        return chat(model, processor, prompt=prompt, image=image, max_tokens=max_tokens, temperature=temperature)
+
+    return _chat
+
+
+def _stream_api():
+    # mlx-vlm's token streamer (newer versions only); None when unavailable.
+    try:
+        from mlx_vlm import stream_generate  # type: ignore
+    except Exception:
+        return None
+    return stream_generate
+
+
+def _generate(server, entry, prompt: str, image, max_tokens: int, temperature: float) -> str:
+    return str(
+        server.generate_api(
+            entry.model,
+            entry.processor,
+            prompt=prompt,
+            image=image,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **server.gen_kwargs,
+        )
+    )
+
+
+def _generate_segments(server, entry, prompt: str, image, max_tokens: int, temperature: float):
+    # Yields text as it is decoded (a single segment on mlx-vlm versions without stream_generate).
+    if server.stream_api is None:
+        yield _generate(server, entry, prompt, image, max_tokens, temperature)
+        return
+    # prompt/image by keyword: their positional order has changed between mlx-vlm releases.
+    for resp in server.stream_api(
+        entry.model,
+        entry.processor,
+        prompt=prompt,
+        image=image,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        **server.gen_kwargs,
+    ):
+        yield resp if isinstance(resp, str) else resp.text
+
+
+def _batch_api():
+    # mlx-vlm's batched decoder (newer versions only); None when unavailable.
+    try:
+        try:
+            from mlx_vlm import batch_generate  # type: ignore
+        except ImportError:
+            from mlx_vlm.generate import batch_generate  # type: ignore
+    except Exception:
+        return None
+    return batch_generate
+
+
+class VlmJob:
+    # One queued completion. Streaming jobs push segments to `out` and watch `cancel`;
+    # the others resolve `future` with the generated text.
+    def __init__(
+        self,
+        model_id: str,
+        prompt: str,
+        image,
+        max_tokens: int,
+        temperature: float,
+        out: queue.Queue | None = None,
+        cancel: threading.Event | None = None,
+    ):
+        self.model_id = model_id
+        self.prompt = prompt
+        self.image = image
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.out = out
+        self.cancel = cancel
+        self.future: Future = Future()
+
+
+def _run_stream(server, job: VlmJob) -> None:
+    try:
+        with server.models.get_or_load(job.model_id).use() as entry:
+            segments = _generate_segments(server, entry, job.prompt, job.image, job.max_tokens, job.temperature)
+            try:
+                for text in segments:
+                    if job.cancel is not None and job.cancel.is_set():
+                        break
+                    job.out.put(("text", text))
+            finally:
+                segments.close()
+        job.out.put(("done", None))
+    except Exception as e:
+        job.out.put(("error", e))
+
+
+def _run_single(server, job: VlmJob) -> None:
+    if job.out is not None:
+        _run_stream(server, job)
+        return
+    try:
+        with server.models.get_or_load(job.model_id).use() as entry:
+            text = _generate(server, entry, job.prompt, job.image, job.max_tokens, job.temperature)
+        job.future.set_result(text)
+    except Exception as e:
+        job.future.set_exception(e)
+
+
+def _run_batch(server, jobs: list[VlmJob]) -> bool:
+    # All jobs share the model, max_tokens and temperature, so one decode loop serves them all.
+    first = jobs[0]
+    try:
+        with server.models.get_or_load(first.model_id).use() as entry:
+            resp = server.batch_api(
+                entry.model,
+                entry.processor,
+                images=[j.image for j in jobs],
+                prompts=[j.prompt for j in jobs],
+                max_tokens=first.max_tokens,
+                temperature=first.temperature,
+                **server.gen_kwargs,
+            )
+        texts = [str(t) for t in getattr(resp, "texts", resp)]
+        if len(texts) != len(jobs):
+            raise RuntimeError(f"expected {len(jobs)} outputs, got {len(texts)}")
+    except Exception as e:
+        print(f"[vlm] batch_generate failed ({e}); running {len(jobs)} requests one at a time")
+        return False
+    for job, text in zip(jobs, texts):
+        job.future.set_result(text)
+    return True
+
+
+def _warmup(server) -> None:
+    # One single-token generation per bucket so the first real request at each size doesn't
+    # pay for kernel compilation.
+    from PIL import Image  # type: ignore
+
+    for size in server.image_buckets:
+        started = time.monotonic()
+        try:
+            with server.models.get_or_load(server.model_id).use() as entry:
+                image = Image.new("RGB", (size, size))
+                _generate(server, entry, "Describe the image.", image, 1, 0.0)
+        except Exception as e:
+            print(f"[vlm] warmup at {size}px failed: {e}")
+            return
+        print(f"[vlm] warmed {size}px in {time.monotonic() - started:.1f}s")
+
+
+def _batch_loop(server) -> None:
+    # Sole owner of the model, and of all MLX work: parking runs here between rounds too, as
+    # MLX isn't safe to drive from several threads. After the first request arrives, waits up
+    # to batch_wait for more (up to max_batch) and decodes compatible ones together; the rest
+    # run one at a time.
+    if server.warmup:
+        _warmup(server)
+    park_every = min(server.park_idle, 30.0)
+    next_park = time.monotonic() + park_every
+    while True:
+        try:
+            first = server.inbox.get(timeout=max(0.0, next_park - time.monotonic()) if park_every > 0 else None)
+        except queue.Empty:
+            first = None
+        if first is not None:
+            _run_round(server, first)
+        if park_every > 0 and time.monotonic() >= next_park:
+            server.models.park_idle(server.park_idle)
+            next_park = time.monotonic() + park_every
+
+
+def _run_round(server, first: VlmJob) -> None:
+    jobs = [first]
+    deadline = time.monotonic() + server.batch_wait
+    while len(jobs) < server.max_batch:
+        timeout = deadline - time.monotonic()
+        try:
+            jobs.append(server.inbox.get(timeout=timeout) if timeout > 0 else server.inbox.get_nowait())
+        except queue.Empty:
+            break
+
+    groups: dict[tuple[str, int, float], list[VlmJob]] = {}
+    for job in jobs:
+        groups.setdefault((job.model_id, job.max_tokens, job.temperature), []).append(job)
+
+    for group in groups.values():
+        streams = [job for job in group if job.out is not None]
+        for job in streams:
+            _run_single(server, job)
+        group = [job for job in group if job.out is None]
+        if len(group) > 1 and server.batch_api is not None and _run_batch(server, group):
+            continue
+        for job in group:
+            _run_single(server, job)
+
+
 class VlmServer(ThreadingHTTPServer):
-    def __init__(self, addr, handler, model_id: str):
+    # Connections beyond http_slots queue in the kernel; socketserver's default backlog of 5
+    # would start refusing them under a modest burst.
+    request_queue_size = 128
+
+    def __init__(self, addr, handler, model_id: str, http_concurrency: int = 16, reuse_port: bool = False):
+        # Caps live connection threads; further connections wait in the listen backlog
+        # instead of piling up threads the single model thread can't serve any faster.
+        self.http_slots = threading.BoundedSemaphore(max(1, http_concurrency))
+        # With --workers, every process binds the same port and the kernel spreads connections.
+        self.reuse_port = reuse_port
         super().__init__(addr, handler)
+        # model_id is the default for requests that don't name one; others load on first use.
         self.model_id = model_id
-        self.model, self.processor = _load_vlm(model_id)
+        self.models = ModelCache(int(os.environ.get("VLM_CACHE_MB", "8192")) * 1024 * 1024)
+        self.models.get_or_load(model_id)
+        self.generate_api = _generate_api()
+        self.stream_api = _stream_api()
+        self.batch_api = _batch_api()
+        self.gen_kwargs = _kv_cache_kwargs(os.environ.get("VLM_KV_DTYPE", "auto"))
+        self.default_max_tokens = int(os.environ.get("VLM_MAX_TOKENS", "256"))
+        self.default_temperature = float(os.environ.get("VLM_TEMPERATURE", "0.2"))
+        self.max_body = int(float(os.environ.get("VLM_MAX_BODY_MB", "64")) * 1024 * 1024)
+        self.results = ResultCache(int(os.environ.get("VLM_RESULT_CACHE_MB", "16")) * 1024 * 1024)
+        self.inflight: dict[bytes, Future] = {}
+        self.inflight_lock = threading.Lock()
+        # HTTP threads only parse and decode images; all model work goes through this inbox.
+        self.image_buckets = tuple(
+            sorted({int(b) for b in os.environ.get("VLM_IMAGE_BUCKETS", "").replace(",", " ").split() if int(b) > 0})
+        )
+        self.warmup = bool(self.image_buckets) and os.environ.get("VLM_WARMUP", "1") != "0"
+        self.max_batch = max(1, int(os.environ.get("VLM_MAX_BATCH", "4")))
+        self.batch_wait = max(0.0, float(os.environ.get("VLM_BATCH_WAIT_MS", "10")) / 1000.0)
+        self.park_idle = float(os.environ.get("VLM_PARK_IDLE_S", "0"))
+        self.inbox: queue.Queue = queue.Queue()
+        threading.Thread(target=_batch_loop, args=(self,), name="vlm-batch", daemon=True).start()
+
+    def server_bind(self) -> None:
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address) -> None:
+        self.http_slots.acquire()
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self.http_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address) -> None:
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.http_slots.release()
+
+
+def _send_all(sock, parts: list[bytes]) -> None:
+    # Gathered write of every part, resuming after partial sends; plain sendall where the
+    # platform has no sendmsg.
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(parts))
+        return
+    views = [memoryview(p) for p in parts if p]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
 
 
 class Handler(BaseHTTPRequestHandler):
     server_version = "agentloop-mlx-vlm/0.1"
+    # Socket read/write timeout. Each connection holds one of the server's http_slots, so a
+    # client that connects and then stalls must eventually give its slot back.
+    timeout = float(os.environ.get("VLM_HTTP_TIMEOUT_S", "30"))
+
+    # Bytes to send along with the buffered headers on the next flush_headers().
+    _body = b""
+
+    def flush_headers(self) -> None:
+        # Headers and the first body bytes leave in one sendmsg(2) rather than two writes.
+        parts = [*getattr(self, "_headers_buffer", ()), self._body]
+        self._headers_buffer = []
+        self._body = b""
+        _send_all(self.connection, parts)
 
     def _send(self, status: int, body: bytes, content_type: str = "application/json; charset=utf-8") -> None:
         self.send_response(status)
         self.send_header("content-type", content_type)
         self.send_header("content-length", str(len(body)))
+        self._body = body
+        self.end_headers()
+
+    def _send_completion(self, model_id: str, content: str) -> None:
+        now = int(time.time())
+        response = {
+            "id": f"chatcmpl-{now}",
+            "object": "chat.completion",
+            "created": now,
+            "model": model_id,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+        }
+        self._send(200, _dumps(response))
+
+    def _stream_completion(self, job: VlmJob) -> None:
+        # OpenAI-style server-sent events: one chat.completion.chunk per decoded segment.
+        now = int(time.time())
+        base = {
+            "id": f"chatcmpl-{now}",
+            "object": "chat.completion.chunk",
+            "created": now,
+            "model": job.model_id,
+        }
+
+        def event(delta: dict, finish_reason: str | None = None) -> bytes:
+            chunk = dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}])
+            return b"data: " + _dumps(chunk) + b"\n\n"
+
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("cache-control", "no-cache")
+        self._body = event({"role": "assistant"})
         self.end_headers()
-        self.wfile.write(body)
+
+        self.server.inbox.put(job)  # type: ignore[attr-defined]
+        try:
+            while True:
+                kind, value = job.out.get()
+                if kind == "done":
+                    break
+                if kind == "error":
+                    err = {"error": f"vlm generation failed: {value}"}
+                    self.wfile.write(b"data: " + _dumps(err) + b"\n\n")
+                    return
+                if value:
+                    self.wfile.write(event({"content": value}))
+                    self.wfile.flush()
+            self.wfile.write(event({}, "stop") + b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # Stop decoding as soon as the client goes away.
+            job.cancel.set()
 
     def do_GET(self) -> None:  # noqa: N802
         if self.path == "/health":
@@ -95,121 +784,145 @@ class Handler(BaseHTTPRequestHandler):
             return
 
         if self.path in ("/v1/models", "/models"):
-            model_id = self.server.model_id  # type: ignore[attr-defined]
-            payload = {"object": "list", "data": [{"id": model_id, "object": "model"}]}
-            self._send(200, json.dumps(payload).encode("utf-8"))
+            self._send(200, self.server.models.listing())  # type: ignore[attr-defined]
             return
 
-        self._send(404, json.dumps({"error": "not found"}).encode("utf-8"))
+        self._send(404, _NOT_FOUND)
 
     def do_POST(self) -> None:  # noqa: N802
         if self.path not in ("/v1/chat/completions", "/chat/completions"):
-            self._send(404, json.dumps({"error": "not found"}).encode("utf-8"))
+            self._send(404, _NOT_FOUND)
             return
 
         length = int(self.headers.get("content-length") or "0")
+        if length > self.server.max_body:  # type: ignore[attr-defined]
+            # Refuse before buffering (and base64-decoding) the body; the unread rest means
+            # this connection can't be reused.
+            self.close_connection = True
+            self._send(413, _dumps({"error": f"request body too large ({length} bytes)"}))
+            return
         raw = self.rfile.read(length) if length > 0 else b"{}"
         try:
-            payload = json.loads(raw.decode("utf-8"))
+            payload = _loads(raw)
         except Exception as e:
-            self._send(400, json.dumps({"error": f"invalid json: {e}"}).encode("utf-8"))
+            self._send(400, _dumps({"error": f"invalid json: {e}"}))
             return
 
         messages = payload.get("messages") or []
         if not isinstance(messages, list) or not messages:
-            self._send(400, json.dumps({"error": "missing messages[]"}).encode("utf-8"))
+            self._send(400, _dumps({"error": "missing messages[]"}))
             return
 
         model_id = str(payload.get("model") or self.server.model_id)  # type: ignore[attr-defined]
-        if model_id != self.server.model_id:  # type: ignore[attr-defined]
-            self._send(
-                400,
-                json.dumps(
-                    {
-                        "error": "this server is started with a single model; restart with VLM_MODEL to change",
-                        "model": self.server.model_id,  # type: ignore[attr-defined]
-                    }
-                ).encode("utf-8"),
-            )
-            return
 
         text = _extract_text(messages)
         image_bytes = _decode_image_from_message(messages)
         if not text and not image_bytes:
-            self._send(400, json.dumps({"error": "provide user text and/or a data: image_url"}).encode("utf-8"))
+            self._send(400, _dumps({"error": "provide user text and/or a data: image_url"}))
             return
 
-        max_tokens = int(payload.get("max_tokens") or int(os.environ.get("VLM_MAX_TOKENS", "256")))
-        temperature = float(payload.get("temperature") or float(os.environ.get("VLM_TEMPERATURE", "0.2")))
-
-        try:
-            from PIL import Image  # type: ignore
+        # Explicit zeros are honoured: temperature 0 is greedy decoding, not "use the default".
+        max_tokens = payload.get("max_tokens")
+        if max_tokens is None:
+            max_tokens = self.server.default_max_tokens  # type: ignore[attr-defined]
+        max_tokens = int(max_tokens)
+        temperature = payload.get("temperature")
+        if temperature is None:
+            temperature = self.server.default_temperature  # type: ignore[attr-defined]
+        temperature = float(temperature)
+
+        # Greedy decoding is deterministic, so identical requests can reuse an earlier answer
+        # and skip both the vision encoder and prefill.
+        result_key = None
+        if temperature == 0 and not payload.get("stream"):
+            result_key = _result_key(model_id, text, image_bytes, max_tokens, self.server.gen_kwargs)  # type: ignore[attr-defined]
+            cached = self.server.results.get(result_key)  # type: ignore[attr-defined]
+            if cached is not None:
+                self._send_completion(model_id, cached)
+                return
+
+        if payload.get("stream"):
+            try:
+                img = self._load_image(model_id, image_bytes)
+            except Exception as e:
+                self._send(500, _dumps({"error": f"vlm generation failed: {e}"}))
+                return
+            self._stream_completion(
+                VlmJob(model_id, text, img, max_tokens, temperature, out=queue.Queue(), cancel=threading.Event())
+            )
+            return
 
-            img = None
-            if image_bytes:
-                img = Image.open(BytesIO(image_bytes)).convert("RGB")
+        # Identical greedy requests already in flight (retries, fanned-out evaluators) wait on
+        # the first one's answer instead of queueing another generation.
+        shared: Future | None = None
+        leader: Future | None = None
+        if result_key is not None:
+            with self.server.inflight_lock:  # type: ignore[attr-defined]
+                leader = self.server.inflight.get(result_key)  # type: ignore[attr-defined]
+                if leader is None:
+                    shared = self.server.inflight[result_key] = Future()  # type: ignore[attr-defined]
 
-            # mlx-vlm API varies by version; try common entry points.
-            try:
-                from mlx_vlm import generate  # type: ignore
-
-                content = generate(
-                    self.server.model,  # type: ignore[attr-defined]
-                    self.server.processor,  # type: ignore[attr-defined]
-                    prompt=text,
-                    image=img,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                )
-            except Exception:
-                # Fallback: some versions expose a `chat` function.
-                from mlx_vlm import chat  # type: ignore
-
-                content = chat(
-                    self.server.model,  # type: ignore[attr-defined]
-                    self.server.processor,  # type: ignore[attr-defined]
-                    prompt=text,
-                    image=img,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                )
+        try:
+            if leader is not None:
+                content = leader.result()
+            else:
+                job = VlmJob(model_id, text, self._load_image(model_id, image_bytes), max_tokens, temperature)
+                self.server.inbox.put(job)  # type: ignore[attr-defined]
+                content = job.future.result()
+                if result_key is not None:
+                    self.server.results.put(result_key, content)  # type: ignore[attr-defined]
         except Exception as e:
-            self._send(500, json.dumps({"error": f"vlm generation failed: {e}"}).encode("utf-8"))
+            if shared is not None:
+                self._settle(result_key, shared, error=e)
+            self._send(500, _dumps({"error": f"vlm generation failed: {e}"}))
             return
 
-        now = int(time.time())
-        response = {
-            "id": f"chatcmpl-{now}",
-            "object": "chat.completion",
-            "created": now,
-            "model": self.server.model_id,  # type: ignore[attr-defined]
-            "choices": [
-                {
-                    "index": 0,
-                    "message": {"role": "assistant", "content": str(content)},
-                    "finish_reason": "stop",
-                }
-            ],
-        }
-        self._send(200, json.dumps(response).encode("utf-8"))
+        if shared is not None:
+            self._settle(result_key, shared, content=content)
+        self._send_completion(model_id, content)
+
+    def _load_image(self, model_id: str, image_bytes: bytes | None):
+        if not image_bytes:
+            return None
+        # The processor is known only once the model is loaded; until then, no pre-shrink.
+        entry = self.server.models.peek(model_id)  # type: ignore[attr-defined]
+        buckets = self.server.image_buckets  # type: ignore[attr-defined]
+        return _open_image(image_bytes, entry.processor if entry else None, buckets)
+
+    def _settle(self, key: bytes, shared: Future, content: str | None = None, error: Exception | None = None) -> None:
+        with self.server.inflight_lock:  # type: ignore[attr-defined]
+            self.server.inflight.pop(key, None)  # type: ignore[attr-defined]
+        if error is not None:
+            shared.set_exception(error)
+        else:
+            shared.set_result(content)
 
     def log_message(self, fmt: str, *args) -> None:  # noqa: A003
         msg = fmt % args
         print(f"[vlm] {self.address_string()} {msg}")
 
 
+def _serve(args, reuse_port: bool = False) -> int:
+    httpd: VlmServer = VlmServer(
+        (args.host, args.port), Handler, args.model, http_concurrency=args.threads_http, reuse_port=reuse_port
+    )
+    print(f"[vlm] listening: http://{args.host}:{args.port} (OpenAI-ish: /v1/chat/completions)")
+    httpd.serve_forever()
+    return 0
+
+
 def main() -> int:
     ap = argparse.ArgumentParser()
     ap.add_argument("--host", default=os.environ.get("VLM_HOST", "127.0.0.1"))
     ap.add_argument("--port", type=int, default=int(os.environ.get("VLM_PORT", "12346")))
     ap.add_argument("--model", default=os.environ.get("VLM_MODEL", "mlx-community/llava-v1.6-mistral-7b-4bit"))
+    ap.add_argument("--threads-http", type=int, default=int(os.environ.get("VLM_HTTP_CONCURRENCY", "16")))
+    # Apple Silicon has one GPU and unified memory: extra workers only duplicate the weights.
+    # More pay off on CUDA/CPU hosts where replicas can decode in parallel.
+    ap.add_argument("--workers", type=int, default=int(os.environ.get("VLM_WORKERS", "1")))
     args = ap.parse_args()
 
-    print(f"[vlm] loading model: {args.model}")
-    httpd: VlmServer = VlmServer((args.host, args.port), Handler, args.model)
-    print(f"[vlm] listening: http://{args.host}:{args.port} (OpenAI-ish: /v1/chat/completions)")
-    httpd.serve_forever()
-    return 0
+    return workers.run(args, _serve, "vlm")
 
 
 if __name__ == "__main__":